@@ -1,23 +1,187 @@
+import gc
+import io
 import os
+import re
 import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import BinaryIO, Union
 
-from flask import Flask, jsonify, render_template, request
+import blake3
+import orjson
+from flask import Flask, Response, jsonify, render_template, request
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
-from parser.document_parser import Chapter, DocumentParser, DocumentParserError
+from parser.document_parser import DocumentParser, DocumentParserError
 
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100MB
+# Entries are never evicted and each distinct upload adds one; clear the directory by
+# hand (or from cron) to reclaim space.
+app.config["CHAPTER_CACHE_DIR"] = os.environ.get(
+    "CHAPTER_CACHE_DIR", os.path.join(app.instance_path, "chapter-cache")
+)
+
+HASH_BLOCK_SIZE = 1024 * 1024
 
 ALLOWED_EXTENSIONS = {".pdf", ".txt", ".epub", ".mobi", ".doc", ".docx"}
 parser = DocumentParser()
 
+# Collect the oldest generation sooner than the default (700, 10, 10) so parse
+# garbage does not pile up in long-lived workers.
+gc.set_threshold(700, 10, 5)
+
+# Parsing runs off the request thread; clients poll /result/<job_id> for the outcome.
+# The job id is the upload's cache key and all job state lives in the cache
+# directory, so any worker process can answer a poll.
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+# Queued plus running jobs per process; uploads beyond this are turned away.
+MAX_PENDING_JOBS = 4 * (os.cpu_count() or 1)
+JOB_SLOTS = threading.BoundedSemaphore(MAX_PENDING_JOBS)
+# A pending marker older than this was left by a worker that died mid-parse.
+PENDING_TTL = 30 * 60
+# How long a failed job's error stays available to /result.
+ERROR_TTL = 10 * 60
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{64}\.[a-z]+")
+
 
 def allowed_file(filename: str) -> bool:
     return Path(filename).suffix.lower() in ALLOWED_EXTENSIONS
 
 
+def save_to_tempfile(file: FileStorage, suffix: str) -> str:
+    """Save formats whose backends only accept a file name (MOBI, DOC)."""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        file.save(tmp.name)
+        return tmp.name
+
+
+def detach_upload(file: FileStorage) -> BinaryIO:
+    """Take over Werkzeug's spooled upload so it outlives the request without a copy."""
+    # Werkzeug keeps uploads up to 500 KB in memory and spools larger ones to a
+    # temporary file, so queued jobs hold at most MAX_PENDING_JOBS * 500 KB of RAM.
+    # The request closes its files on teardown; leave it an empty stand-in to close.
+    stream = file.stream
+    file.stream = io.BytesIO()
+    return stream
+
+
+def run_parse_job(source: Union[str, BinaryIO], suffix: str, job_id: str) -> None:
+    """Parse an upload in the background and store the JSON response body in the cache."""
+    try:
+        if isinstance(source, str):
+            chapters = parser.parse(source)
+        else:
+            chapters = parser.parse_stream(source, suffix)
+    finally:
+        if isinstance(source, str):
+            os.unlink(source)
+        else:
+            source.close()
+    # orjson serializes the Chapter dataclasses natively, without building dicts first.
+    payload = orjson.dumps({"chapters": chapters})
+    # Only the encoded payload is needed from here on; release the chapters and
+    # any parser garbage before the worker picks up its next job.
+    del chapters
+    gc.collect()
+    write_cache(cache_path(job_id), payload)
+
+
+def finish_job(job_id: str, future: Future) -> None:
+    """Record why a job failed for /result, then release its pending marker and slot."""
+    try:
+        exc = future.exception()
+        if isinstance(exc, DocumentParserError):
+            record_error(job_id, 400, str(exc))
+        elif exc is not None:
+            app.logger.error("解析任务失败: %s", job_id, exc_info=exc)
+            record_error(job_id, 500, "解析文件时发生未知错误")
+    finally:
+        release_job(job_id)
+
+
+def record_error(job_id: str, status: int, message: str) -> None:
+    write_cache(cache_path(job_id, "error.json"), orjson.dumps({"status": status, "error": message}))
+
+
+def claim_job(job_id: str) -> bool:
+    """Create the job's pending marker; False if a live job already holds it."""
+    marker = cache_path(job_id, "pending")
+    marker.parent.mkdir(mode=0o700, exist_ok=True)
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+    except FileExistsError:
+        if is_fresh(marker, PENDING_TTL):
+            return False
+        # Left behind by a worker that died mid-parse; take the job over.
+        marker.touch()
+    return True
+
+
+def release_job(job_id: str) -> None:
+    cache_path(job_id, "pending").unlink(missing_ok=True)
+    JOB_SLOTS.release()
+
+
+def is_fresh(path: Path, ttl: float) -> bool:
+    try:
+        return time.time() - path.stat().st_mtime < ttl
+    except FileNotFoundError:
+        return False
+
+
+def hash_upload(stream: BinaryIO) -> str:
+    """Return the BLAKE3 hex digest of an upload and rewind it for parsing."""
+    hasher = blake3.blake3()
+    for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b""):
+        hasher.update(block)
+    stream.seek(0)
+    return hasher.hexdigest()
+
+
+def cache_root(directory: str) -> Path:
+    """Create the cache directory private to this user, refusing one someone else owns."""
+    # Checked on every use, not once per process, so clearing the directory by hand
+    # (see the CHAPTER_CACHE_DIR note) only costs the next request a mkdir.
+    root = Path(directory)
+    root.mkdir(mode=0o700, parents=True, exist_ok=True)
+    info = root.stat()
+    # Anyone who can write here can plant responses for uploads they never made.
+    if hasattr(os, "getuid") and info.st_uid != os.getuid():
+        raise RuntimeError(f"章节缓存目录不属于当前用户: {root}")
+    if info.st_mode & 0o077:
+        root.chmod(0o700)
+    return root
+
+
+def cache_path(job_id: str, kind: str = "json") -> Path:
+    """Return the file holding a job's result (``json``), error or pending marker."""
+    # Results from older parser versions live in their own directory and are never read.
+    version_dir = cache_root(app.config["CHAPTER_CACHE_DIR"]) / f"v{parser.output_version}"
+    return version_dir / f"{job_id}.{kind}"
+
+
+def write_cache(path: Path, payload: bytes) -> None:
+    """Store a response body atomically so readers never see a partial file."""
+    tmp_path = None
+    try:
+        path.parent.mkdir(mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(payload)
+        os.replace(tmp_path, path)
+    except OSError:
+        app.logger.warning("无法写入章节缓存: %s", path, exc_info=True)
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        # The cache is where /result finds the outcome, so the job cannot succeed without it.
+        raise
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -38,22 +202,50 @@ def upload():
 
     suffix = Path(filename).suffix.lower()
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        file.save(tmp.name)
-        tmp_path = tmp.name
+    # The suffix is part of the key: the same bytes parse differently as .txt and .pdf.
+    job_id = f"{hash_upload(file.stream)}{suffix}"
+    cached = cache_path(job_id)
+    if cached.is_file():
+        return Response(cached.read_bytes(), mimetype="application/json")
 
-    try:
-        chapters = parser.parse(tmp_path)
-    except DocumentParserError as exc:
-        os.unlink(tmp_path)
-        return jsonify({"error": str(exc)}), 400
-    except Exception as exc:  # pragma: no cover - fallback error
-        os.unlink(tmp_path)
-        return jsonify({"error": "解析文件时发生未知错误"}), 500
-
-    os.unlink(tmp_path)
+    # The same bytes are already being parsed, possibly by another worker; poll that job.
+    if not claim_job(job_id):
+        return jsonify({"job_id": job_id}), 202
+    if not JOB_SLOTS.acquire(blocking=False):
+        cache_path(job_id, "pending").unlink(missing_ok=True)
+        return jsonify({"error": "服务器繁忙，请稍后重试"}), 503
 
-    return jsonify({"chapters": [chapter.__dict__ for chapter in chapters]})
+    try:
+        # The request's upload stream is closed once this view returns: stream formats
+        # take the stream over, the rest need a named file and free the upload at once.
+        if suffix in parser.stream_extensions:
+            source: Union[str, BinaryIO] = detach_upload(file)
+        else:
+            source = save_to_tempfile(file, suffix)
+            file.close()
+        future = EXECUTOR.submit(run_parse_job, source, suffix, job_id)
+    except BaseException:
+        release_job(job_id)
+        raise
+    future.add_done_callback(partial(finish_job, job_id))
+    return jsonify({"job_id": job_id}), 202
+
+
+@app.route("/result/<job_id>")
+def result(job_id: str):
+    if JOB_ID_PATTERN.fullmatch(job_id) and allowed_file(job_id):
+        # A job writes its result or error before dropping the marker, so checking
+        # the marker first never misses an outcome that lands in between.
+        if is_fresh(cache_path(job_id, "pending"), PENDING_TTL):
+            return jsonify({"job_id": job_id}), 202
+        cached = cache_path(job_id)
+        if cached.is_file():
+            return Response(cached.read_bytes(), mimetype="application/json")
+        error_path = cache_path(job_id, "error.json")
+        if is_fresh(error_path, ERROR_TTL):
+            error = orjson.loads(error_path.read_bytes())
+            return jsonify({"error": error["error"]}), error["status"]
+    return jsonify({"error": "解析任务不存在或已过期"}), 404
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,65 @@
+"""Per-line chapter splitting loop, kept free of third-party imports for mypyc.
+
+This runs as plain Python. ``mypyc parser/_chapters.py`` compiles it in place,
+after which ``document_parser`` imports the native build instead.
+"""
+import io
+from typing import FrozenSet, Iterable, List, Optional, Pattern, Tuple
+
+
+def clean_text(text: str) -> str:
+    return text.replace("\u3000", " ").replace("\r", "")
+
+
+def split_sections(
+    lines: Iterable[str],
+    heading_pattern: Pattern[str],
+    heading_initials: FrozenSet[str],
+    heading_numerals: FrozenSet[str],
+) -> Tuple[List[Tuple[Optional[str], str]], Optional[str]]:
+    """Group lines into ``(heading, content)`` pairs.
+
+    ``lines`` must already have been through ``clean_text``; readers clean whole
+    pages or decoded blocks at once, which is far cheaper than cleaning per line.
+    ``heading`` is ``None`` only for text that appears before the first heading.
+    Also returns the unstripped lines joined by ``"\n"`` for the fixed-size
+    fallback, or ``None`` once there are two sections and it can no longer apply.
+    """
+    sections: List[Tuple[Optional[str], str]] = []
+    current_title: Optional[str] = None
+    raw_lines: List[str] = []
+    keep_raw = True
+    # Each line is written followed by "\n"; the trailing one is stripped on flush.
+    current_content = io.StringIO()
+    write = current_content.write
+    for line in lines:
+        if keep_raw:
+            raw_lines.append(line)
+        stripped = line.strip()
+        if not stripped:
+            write("\n")
+            continue
+        # Nearly every line is rejected here without entering the regex engine.
+        if stripped[0] in heading_initials and is_heading(stripped, heading_pattern, heading_numerals):
+            if current_content.tell():
+                sections.append((current_title, current_content.getvalue().strip()))
+                current_content = io.StringIO()
+                write = current_content.write
+                if len(sections) == 2:
+                    keep_raw = False
+                    raw_lines = []
+            current_title = stripped
+        write(stripped)
+        write("\n")
+    if current_content.tell():
+        sections.append((current_title, current_content.getvalue().strip()))
+    return sections, "\n".join(raw_lines) if len(sections) <= 1 else None
+
+
+def is_heading(line: str, heading_pattern: Pattern[str], heading_numerals: FrozenSet[str]) -> bool:
+    if line[0] == "第":
+        # ``\d`` in the pattern also accepts full-width digits, hence isdecimal().
+        numeral = line[1:2]
+        if numeral not in heading_numerals and not numeral.isdecimal():
+            return False
+    return heading_pattern.match(line) is not None
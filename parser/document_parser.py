@@ -1,19 +1,55 @@
+import codecs
+import io
+import mmap
 import os
+import posixpath
 import re
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import unquote
 
-from bs4 import BeautifulSoup
-from ebooklib import epub
-from pdfminer.high_level import extract_text
+import pypdfium2 as pdfium
 from mobi import Mobi
-from docx import Document
+
+from ._chapters import clean_text, split_sections
+
+try:  # pragma: no cover - optional dependency
+    from lxml import etree
+except ImportError:  # pragma: no cover - optional dependency
+    import xml.etree.ElementTree as etree
+
+try:  # pragma: no cover - optional dependency
+    from selectolax.parser import HTMLParser
+except ImportError:  # pragma: no cover - optional dependency
+    HTMLParser = None
+    from bs4 import BeautifulSoup
 
 try:  # pragma: no cover - optional dependency
     import textract
 except ImportError:  # pragma: no cover - optional dependency
     textract = None
 
+# pdfium is not thread-safe, and pypdfium2 releases the GIL around every call, so
+# parses running in pool threads must take turns inside the library.
+_PDFIUM_LOCK = threading.Lock()
+
+_TXT_BLOCK_SIZE = 64 * 1024
+# Characters ``str.splitlines`` breaks on, besides the "\r" normalised away beforehand.
+_LINE_BOUNDARIES = frozenset("\n\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029")
+
+_CONTAINER_NS = "{urn:oasis:names:tc:opendocument:xmlns:container}"
+_OPF_NS = "{http://www.idpf.org/2007/opf}"
+
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P = f"{_WORD_NS}p"
+_W_R = f"{_WORD_NS}r"
+_W_T = f"{_WORD_NS}t"
+_W_TAB = f"{_WORD_NS}tab"
+_W_BREAKS = {f"{_WORD_NS}br", f"{_WORD_NS}cr"}
+
 
 @dataclass
 class Chapter:
@@ -28,81 +64,166 @@ class DocumentParserError(Exception):
 class DocumentParser:
     """Parse different document types into chapters."""
 
+    block_tags = ("h1", "h2", "h3", "h4", "h5", "h6", "p", "div")
+
     heading_pattern = re.compile(
         r"^(?:\s*)(?:(第[\d一二三四五六七八九十百千万零两]+[章节回部卷])|((?:chapter|section|part)\s+\d+))",
         re.IGNORECASE,
     )
+    # First characters ``heading_pattern`` can match on a stripped line.
+    heading_initials = frozenset("第CcSsPp")
+    heading_numerals = frozenset("0123456789一二三四五六七八九十百千万零两")
+
+    # Formats whose backends read from a file object, so uploads need no temp file.
+    stream_extensions = frozenset({".pdf", ".txt", ".docx", ".epub"})
+
+    # Bump whenever a change alters the chapters produced; cached results are keyed on it.
+    output_version = 3
+
+    def __init__(self) -> None:
+        # Maps an extension to its reader and the default title used to split the
+        # lines it yields into chapters; None means the reader returns chapters itself.
+        self._dispatch: Dict[str, Tuple[Callable, Optional[str]]] = {
+            ".pdf": (self._parse_pdf, "PDF 章节"),
+            ".txt": (self._parse_txt, "文本章节"),
+            ".epub": (self._parse_epub, None),
+            ".mobi": (self._parse_mobi, None),
+            ".doc": (self._parse_doc, "Word 章节"),
+            ".docx": (self._parse_docx, "Word 章节"),
+        }
 
     def parse(self, file_path: str) -> List[Chapter]:
-        ext = os.path.splitext(file_path)[1].lower()
-        if ext == ".pdf":
-            text = self._parse_pdf(file_path)
-            return self._split_into_chapters(text, default_title="PDF 章节")
-        if ext == ".txt":
-            text = self._parse_txt(file_path)
-            return self._split_into_chapters(text, default_title="文本章节")
-        if ext == ".epub":
-            return self._parse_epub(file_path)
-        if ext == ".mobi":
-            return self._parse_mobi(file_path)
-        if ext == ".doc":
-            text = self._parse_doc(file_path)
-            return self._split_into_chapters(text, default_title="Word 章节")
-        if ext == ".docx":
-            text = self._parse_docx(file_path)
-            return self._split_into_chapters(text, default_title="Word 章节")
-        raise DocumentParserError(f"暂不支持的文件类型: {ext}")
-
-    def _parse_pdf(self, file_path: str) -> str:
+        _, dot, ext = os.path.basename(file_path).rpartition(".")
+        return self._parse_source(file_path, f".{ext.lower()}" if dot else "")
+
+    def parse_stream(self, stream: BinaryIO, ext: str) -> List[Chapter]:
+        """Parse an open binary stream (such as an uploaded file) of type ``ext``."""
+        ext = ext.lower()
+        if ext not in self.stream_extensions:
+            raise DocumentParserError(f"暂不支持直接解析的文件类型: {ext}")
+        return self._parse_source(stream, ext)
+
+    def _parse_source(self, source: Union[str, BinaryIO], ext: str) -> List[Chapter]:
+        try:
+            reader, default_title = self._dispatch[ext]
+        except KeyError:
+            raise DocumentParserError(f"暂不支持的文件类型: {ext}") from None
+        if default_title is None:
+            return reader(source)
+        return self._split_into_chapters(reader(source), default_title=default_title)
+
+    def _parse_pdf(self, source: Union[str, BinaryIO]) -> Iterator[str]:
+        """Yield the lines of each PDF page in order."""
+        try:
+            with _PDFIUM_LOCK:
+                document = pdfium.PdfDocument(source)
+                page_count = len(document)
+        except Exception as exc:  # pragma: no cover - pdfium specific errors
+            raise DocumentParserError("解析 PDF 文件失败") from exc
         try:
-            return extract_text(file_path)
-        except Exception as exc:  # pragma: no cover - pdfminer specific errors
+            for index in range(page_count):
+                # Held per page rather than across the yield, so parses in other
+                # threads interleave page by page instead of waiting for whole files.
+                with _PDFIUM_LOCK:
+                    page = document[index]
+                    try:
+                        textpage = page.get_textpage()
+                        try:
+                            text = textpage.get_text_bounded()
+                        finally:
+                            textpage.close()
+                    finally:
+                        page.close()
+                yield from self._clean_text(text).splitlines()
+        except Exception as exc:  # pragma: no cover - pdfium specific errors
             raise DocumentParserError("解析 PDF 文件失败") from exc
+        finally:
+            with _PDFIUM_LOCK:
+                document.close()
 
-    def _parse_txt(self, file_path: str) -> str:
+    def _parse_txt(self, source: Union[str, BinaryIO]) -> Iterator[str]:
+        """Yield the lines of a text file without reading it into memory at once."""
+        if not isinstance(source, str):
+            yield from self._iter_utf8_lines(source.read)
+            return
         try:
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as handle:
-                return handle.read()
+            handle = open(source, "rb")
         except Exception as exc:
             raise DocumentParserError("读取文本文件失败") from exc
+        with handle:
+            # mmap refuses empty files, and there is nothing to yield for them anyway.
+            if os.fstat(handle.fileno()).st_size == 0:
+                return
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from self._iter_utf8_lines(mapped.read)
 
-    def _parse_docx(self, file_path: str) -> str:
+    def _parse_docx(self, source: Union[str, BinaryIO]) -> Iterator[str]:
+        """Yield paragraph text by streaming ``word/document.xml`` out of the archive."""
         try:
-            document = Document(file_path)
+            archive = zipfile.ZipFile(source)
         except Exception as exc:
             raise DocumentParserError("解析 Word 文件失败") from exc
-        paragraphs = [para.text for para in document.paragraphs]
-        return "\n".join(paragraphs)
+        with archive:
+            try:
+                with archive.open("word/document.xml") as document:
+                    for paragraph in self._iter_docx_paragraphs(document):
+                        yield from self._clean_text(self._docx_paragraph_text(paragraph)).split("\n")
+            # lxml's XMLSyntaxError and ElementTree's ParseError both derive from SyntaxError.
+            except (KeyError, zipfile.BadZipFile, SyntaxError) as exc:
+                raise DocumentParserError("解析 Word 文件失败") from exc
 
-    def _parse_doc(self, file_path: str) -> str:
+    def _parse_doc(self, file_path: str) -> Iterable[str]:
         if textract is None:
             raise DocumentParserError("解析 DOC 文件需要安装 textract 依赖")
         try:
             content = textract.process(file_path)
         except Exception as exc:  # pragma: no cover - textract backend specific
             raise DocumentParserError("解析 DOC 文件失败") from exc
-        try:
-            return content.decode("utf-8")
-        except UnicodeDecodeError:
-            return content.decode("gb18030", errors="ignore")
+        return self._clean_text(self._decode_text(content)).splitlines()
 
-    def _parse_epub(self, file_path: str) -> List[Chapter]:
+    def _parse_epub(self, source: Union[str, BinaryIO]) -> List[Chapter]:
+        """Read XHTML documents straight from the EPUB's ZIP container, in manifest order."""
         try:
-            book = epub.read_epub(file_path)
+            archive = zipfile.ZipFile(source)
         except Exception as exc:
             raise DocumentParserError("解析 EPUB 文件失败") from exc
-        chapters: List[Chapter] = []
-        for item in book.get_items_of_type(epub.ITEM_DOCUMENT):
-            title = self._guess_title(item.get_name())
-            soup = BeautifulSoup(item.get_body_content(), "html.parser")
-            text = soup.get_text("\n")
-            text = self._clean_text(text)
-            if text.strip():
-                chapters.append(Chapter(title=title, content=text))
+        with archive:
+            try:
+                names = self._epub_document_names(archive)
+                # Documents are independent; map() keeps them in manifest order.
+                with ThreadPoolExecutor() as executor:
+                    results = executor.map(lambda name: self._parse_epub_item(name, archive.read(name)), names)
+                    chapters = [chapter for chapter in results if chapter]
+            except (KeyError, zipfile.BadZipFile, SyntaxError) as exc:
+                raise DocumentParserError("解析 EPUB 文件失败") from exc
         if not chapters:
             raise DocumentParserError("未能从 EPUB 文件中提取章节")
         return chapters
 
+    @staticmethod
+    def _epub_document_names(archive: zipfile.ZipFile) -> List[str]:
+        container = etree.fromstring(archive.read("META-INF/container.xml"))
+        rootfile = container.find(f".//{_CONTAINER_NS}rootfile")
+        if rootfile is None or not rootfile.get("full-path"):
+            raise DocumentParserError("解析 EPUB 文件失败")
+        opf_path = rootfile.get("full-path")
+        package = etree.fromstring(archive.read(opf_path))
+        # Manifest hrefs are URL-encoded and relative to the OPF file.
+        opf_dir = posixpath.dirname(opf_path)
+        return [
+            posixpath.normpath(posixpath.join(opf_dir, unquote(item.get("href", ""))))
+            for item in package.iter(f"{_OPF_NS}item")
+            if item.get("media-type") == "application/xhtml+xml"
+        ]
+
+    def _parse_epub_item(self, name: str, markup: bytes) -> Optional[Chapter]:
+        title = self._guess_title(name)
+        text = self._html_text(markup)
+        text = self._clean_text(text)
+        if not text.strip():
+            return None
+        return Chapter(title=title, content=text)
+
     def _parse_mobi(self, file_path: str) -> List[Chapter]:
         try:
             book = Mobi(file_path)
@@ -112,75 +233,193 @@ class DocumentParser:
                 raw_html = raw_html.decode("utf-8", errors="ignore")
         except Exception as exc:  # pragma: no cover - mobi parsing heavy
             raise DocumentParserError("解析 MOBI 文件失败") from exc
-        soup = BeautifulSoup(raw_html, "html.parser")
-        elements = soup.find_all(["h1", "h2", "h3", "h4", "h5", "h6", "p", "div"])
         chapters: List[Chapter] = []
         current_title = "MOBI 章节"
-        current_content: List[str] = []
-        for element in elements:
-            if element.name in {"h1", "h2", "h3"}:
-                if current_content:
+        current_content = io.StringIO()
+        for tag, element_text in self._html_blocks(raw_html):
+            if tag in {"h1", "h2", "h3"}:
+                if current_content.tell():
                     chapters.append(
-                        Chapter(title=current_title.strip() or "MOBI 章节", content="\n".join(current_content).strip())
+                        Chapter(title=current_title.strip() or "MOBI 章节", content=current_content.getvalue().strip())
                     )
-                    current_content = []
-                current_title = self._clean_text(element.get_text(" "))
+                    current_content = io.StringIO()
+                current_title = self._clean_text(element_text)
             else:
-                current_content.append(self._clean_text(element.get_text(" ")))
-        if current_content:
+                current_content.write(self._clean_text(element_text))
+                current_content.write("\n")
+        if current_content.tell():
             chapters.append(
-                Chapter(title=current_title.strip() or "MOBI 章节", content="\n".join(current_content).strip())
+                Chapter(title=current_title.strip() or "MOBI 章节", content=current_content.getvalue().strip())
             )
         if not chapters:
-            text = soup.get_text("\n")
-            return self._split_into_chapters(text, default_title="MOBI 章节")
+            text = self._html_text(raw_html)
+            return self._split_into_chapters(self._clean_text(text).splitlines(), default_title="MOBI 章节")
         return chapters
 
-    def _split_into_chapters(self, text: str, default_title: str) -> List[Chapter]:
-        cleaned = self._clean_text(text)
-        lines = cleaned.splitlines()
-        chapters: List[Chapter] = []
-        current_title = None
-        current_content: List[str] = []
-        for line in lines:
-            stripped = line.strip()
-            if not stripped:
-                current_content.append("")
-                continue
-            if self.heading_pattern.match(stripped):
-                if current_content:
-                    chapters.append(
-                        Chapter(
-                            title=current_title or f"{default_title} {len(chapters) + 1}",
-                            content="\n".join(current_content).strip(),
-                        )
-                    )
-                    current_content = []
-                current_title = stripped
-            current_content.append(stripped)
-        if current_content:
-            chapters.append(
-                Chapter(
-                    title=current_title or (f"{default_title} {len(chapters) + 1}" if chapters else default_title),
-                    content="\n".join(current_content).strip(),
-                )
-            )
-        if len(chapters) <= 1:
+    def _split_into_chapters(self, lines: Iterable[str], default_title: str) -> List[Chapter]:
+        """Split a stream of already cleaned lines into chapters."""
+        sections, text = split_sections(lines, self.heading_pattern, self.heading_initials, self.heading_numerals)
+        chapters = [
+            Chapter(title=heading or f"{default_title} {number}", content=content)
+            for number, (heading, content) in enumerate(sections, start=1)
+        ]
+        if text is not None:
+            # Windows are cut from the unstripped text, so indentation counts as before.
             chunk_size = 1200
-            text_length = len(cleaned)
+            text_length = len(text)
             if text_length <= chunk_size:
-                return [Chapter(title=default_title, content=cleaned.strip())]
-            chapters = []
-            for index in range(0, text_length, chunk_size):
-                chunk = cleaned[index : index + chunk_size]
-                chapters.append(
-                    Chapter(title=f"{default_title} {len(chapters) + 1}", content=chunk.strip())
-                )
+                return [Chapter(title=default_title, content=text.strip())]
+            # One slice per window; strip() returns the slice itself when there is nothing to trim.
+            chapters = [
+                Chapter(title=f"{default_title} {number}", content=text[start : start + chunk_size].strip())
+                for number, start in enumerate(range(0, text_length, chunk_size), start=1)
+            ]
         return chapters
 
     @staticmethod
     def _clean_text(text: str) -> str:
-        return re.sub(r"\u3000", " ", text).replace("\r", "")
+        return clean_text(text)
+
+    @staticmethod
+    def _decode_text(content: bytes) -> str:
+        """Decode as UTF-8, or as GB18030 when the bytes are not UTF-8."""
+        # Not final: a multi-byte character cut at the 4 KB boundary is not an error.
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            sniffed = decoder.decode(content[:4096], final=False)
+        except UnicodeDecodeError:
+            return content.decode("gb18030", errors="ignore")
+        if not sniffed.isascii():
+            return content.decode("utf-8", errors="ignore")
+        # Only ASCII so far, possibly followed by a lead byte held back at the boundary
+        # (which may just as well be GB18030). ASCII is valid in both encodings, so the
+        # prefix decides nothing; a strict decode of the whole buffer fails fast instead.
+        try:
+            return content.decode("utf-8")
+        except UnicodeDecodeError:
+            return content.decode("gb18030", errors="ignore")
+
+    @staticmethod
+    def _html_text(markup) -> str:
+        """Return the text of the document body, or of the whole markup if it has none."""
+        if HTMLParser is None:
+            soup = BeautifulSoup(markup, "html.parser")
+            return (soup.body or soup).get_text("\n")
+        tree = HTMLParser(markup)
+        node = tree.body or tree.root
+        return node.text(separator="\n") if node is not None else ""
+
+    @classmethod
+    def _html_blocks(cls, markup) -> Iterator[Tuple[str, str]]:
+        """Yield ``(tag, text)`` for every block element in document order."""
+        if HTMLParser is None:
+            soup = BeautifulSoup(markup, "html.parser")
+            for element in soup.find_all(list(cls.block_tags)):
+                yield element.name, element.get_text(" ")
+            return
+        for node in HTMLParser(markup).css(",".join(cls.block_tags)):
+            yield node.tag, node.text(separator=" ")
+
+    @staticmethod
+    def _iter_utf8_lines(read: Callable[[int], bytes]) -> Iterator[str]:
+        """Decode and clean UTF-8 block by block, yielding lines as ``str.splitlines`` splits them."""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        # Pieces of a line that spans several blocks, joined once the line ends.
+        partial: List[str] = []
+        pending_cr = False
+        for block in iter(lambda: read(_TXT_BLOCK_SIZE), b""):
+            text = decoder.decode(block)
+            if pending_cr:
+                text = "\r" + text
+            # A trailing "\r" may be the first half of a "\r\n" that straddles two blocks.
+            pending_cr = text.endswith("\r")
+            if pending_cr:
+                text = text[:-1]
+            if not text:
+                continue
+            # Old Mac files end lines with a bare "\r", which clean_text would delete.
+            text = clean_text(text.replace("\r\n", "\n").replace("\r", "\n"))
+            lines = text.splitlines()
+            if text[-1] in _LINE_BOUNDARIES:
+                # The block ends on a line break, so the next block starts a fresh line.
+                lines.append("")
+            if len(lines) == 1:
+                partial.append(lines[0])
+                continue
+            partial.append(lines[0])
+            yield "".join(partial)
+            yield from lines[1:-1]
+            partial = [lines[-1]]
+        tail = "".join(partial) + clean_text(decoder.decode(b"", final=True))
+        if tail or pending_cr:
+            yield tail
+
+    @staticmethod
+    def _iter_docx_paragraphs(document: BinaryIO) -> Iterator:
+        """Yield top-level ``w:p`` elements, discarding each one once the caller is done with it."""
+        # Text boxes nest whole paragraphs inside a run of the anchoring paragraph, and
+        # Word stores each box twice (mc:Choice and mc:Fallback); only the outermost
+        # paragraph is yielded, since python-docx never returned the nested ones.
+        if not hasattr(etree, "LXML_VERSION"):
+            # ElementTree has no getparent(), so open elements are tracked on a stack.
+            open_elements: List = []
+            depth = 0
+            for event, element in etree.iterparse(document, events=("start", "end")):
+                if event == "start":
+                    open_elements.append(element)
+                    if element.tag == _W_P:
+                        depth += 1
+                    continue
+                open_elements.pop()
+                if element.tag == _W_P:
+                    depth -= 1
+                    if depth:
+                        continue
+                    yield element
+                elif depth:
+                    continue
+                # Drop every finished element outside a paragraph (paragraphs, tables,
+                # rows) so the tree never grows past the path to the current element.
+                element.clear()
+                if open_elements:
+                    open_elements[-1].remove(element)
+            return
+        # iterparse() resolves external entities by default, which would let an upload
+        # pull local files into its own text; python-docx never resolved them.
+        for _, paragraph in etree.iterparse(document, tag=_W_P, resolve_entities=False, no_network=True):
+            if next(paragraph.iterancestors(_W_P), None) is not None:
+                continue
+            yield paragraph
+            # Drop finished paragraphs so memory stays flat on long documents.
+            paragraph.clear()
+            while paragraph.getprevious() is not None:
+                del paragraph.getparent()[0]
+
+    @classmethod
+    def _docx_paragraph_text(cls, paragraph) -> str:
+        # iter() yields the paragraph itself first; anything after it is a text box.
+        nested = paragraph.iter(_W_P)
+        next(nested)
+        runs = paragraph.iter(_W_R) if next(nested, None) is None else cls._iter_docx_runs(paragraph)
+        parts: List[str] = []
+        for run in runs:
+            for node in run:
+                if node.tag == _W_T:
+                    parts.append(node.text or "")
+                elif node.tag == _W_TAB:
+                    parts.append("\t")
+                elif node.tag in _W_BREAKS:
+                    parts.append("\n")
+        return "".join(parts)
+
+    @classmethod
+    def _iter_docx_runs(cls, element) -> Iterator:
+        """Yield the runs of a paragraph holding text boxes, skipping the boxes' own runs."""
+        for child in element:
+            if child.tag == _W_R:
+                yield child
+            elif child.tag != _W_P:
+                yield from cls._iter_docx_runs(child)
 
     @staticmethod
     def _guess_title(name: str) -> str:
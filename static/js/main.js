@@ -11,6 +11,8 @@ let chapters = [];
 let activeChapterIndex = -1;
 let isSyncingSlider = false;
 
+const POLL_INTERVAL_MS = 500;
+
 fileInput.addEventListener('change', async (event) => {
   const [file] = event.target.files;
   if (!file) {
@@ -24,11 +26,17 @@ fileInput.addEventListener('change', async (event) => {
   formData.append('file', file);
 
   try {
-    const response = await fetch('/upload', {
+    let response = await fetch('/upload', {
       method: 'POST',
       body: formData,
     });
-    const payload = await response.json();
+    let payload = await response.json();
+    // 202 means parsing continues in the background; poll until it finishes.
+    while (response.status === 202) {
+      await delay(POLL_INTERVAL_MS);
+      response = await fetch(`/result/${payload.job_id}`);
+      payload = await response.json();
+    }
     if (!response.ok) {
       throw new Error(payload.error || '解析失败');
     }
@@ -131,6 +139,10 @@ function resetState() {
   positionSlider.value = 0;
 }
 
+function delay(ms) {
+  return new Promise((resolve) => window.setTimeout(resolve, ms));
+}
+
 function showError(message, isError = true) {
   if (!message) {
     errorMessage.hidden = true;